@@ -6,11 +6,15 @@ Version: 1.0.0
 Date: 21.02.2021
 """
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from os import cpu_count, scandir
 from pathlib import Path
-from json import loads
-from subprocess import Popen, run
-from sys import stderr
-from re import compile
+from hashlib import blake2b
+from json import loads, dumps
+from subprocess import run
+from sys import stderr, stdout
+from time import sleep
 
 
 class Colors:
@@ -26,8 +30,17 @@ class Colors:
     UNDERLINE = '\033[4m'
 
 
+# Escape sequences are only useful in a terminal, not in pipes and logs
+if not stdout.isatty():
+    for color in [name for name in vars(Colors) if name.isupper()]:
+        setattr(Colors, color, "")
+
+
 dirname = Path.cwd()
 config_file_name = "ctestconfig.json"
+watch_interval = 0.5
+# Test results cache by executable path, kept between runs in watch mode
+loaded_cache = {}
 default_config = {
     "compiler": "gcc",
     "args": "--std=c99 -Wall -Werror "
@@ -35,36 +48,138 @@ default_config = {
     "coverage_meter": "gcov",
     "coverage_meter_args": "-b",
     "tests_dir": "func_tests",
-    "test_file_regex": "(pos|neg)_([0-9]{2})_(in|out)\.txt",
-    "tests_encoding": "utf-8"
+    "tests_encoding": "utf-8",
+    "tests_cache": ".ctestcache.json",
+    "tests_jobs": None
 }
 
 
-def get_file_name() -> str:
+def get_args():
     """
-    Gets the name of the file from the user
-    :return: Received file name as string
+    Gets the command line arguments from the user
+    :return: Parsed arguments (file name and watch flag)
     """
     parser = ArgumentParser(description="Build & test your C programs")
     parser.add_argument("file", type=str, help="The path to your C file")
-    args = parser.parse_args()
-    return args.file
+    parser.add_argument("--watch", action="store_true",
+                        help="Rebuild and retest when the file or tests "
+                             "change")
+    return parser.parse_args()
 
 
+@lru_cache(maxsize=1)
 def get_config() -> dict:
     """
     Gets the configuration, merging default and specified in
-    ctestconfig.json
+    ctestconfig.json. The file is read only once
     :return: Merged config as dict
     """
-    config = default_config
+    loaded = {}
     config_path = dirname / config_file_name
     if Path.exists(config_path):
         with open(config_path, "r") as config_file:
-            config.update(loads(config_file.read()))
+            loaded = loads(config_file.read())
+    for key in loaded:
+        if key == "test_file_regex":
+            print(Colors.WARNING + "Warning: test_file_regex is no longer "
+                  "supported, test files must be named like pos_01_in.txt "
+                  "and pos_01_out.txt", file=stderr)
+        elif key not in default_config:
+            print(Colors.WARNING + "Warning: unknown config option", key,
+                  file=stderr)
+    config = {**default_config, **loaded}
+    jobs = config["tests_jobs"]
+    if jobs is not None and (type(jobs) is not int or jobs < 1):
+        print(Colors.WARNING + "Warning: tests_jobs must be a positive "
+              "integer, using the number of CPUs", file=stderr)
+        config["tests_jobs"] = None
+    # Split once here instead of on every build/coverage call
+    config["_args"] = config["args"].split()
+    config["_coverage_meter_args"] = config["coverage_meter_args"].split()
+    # An executable built with coverage has to run every test to count it
+    config["_coverage"] = "--coverage" in config["_args"] or \
+        "-fprofile-arcs" in config["_args"]
     return config
 
 
+def read_cache(config) -> dict:
+    """
+    Reads the test results cache file, skipping malformed entries
+    :param config: The configuration
+    :return: Cached results by executable path
+    """
+    cache_path = dirname / config["tests_cache"]
+    if not cache_path.exists():
+        return {}
+    with open(cache_path, "r") as cache_file:
+        try:
+            cache = loads(cache_file.read())
+        except ValueError:
+            return {}
+    if not isinstance(cache, dict):
+        return {}
+    return {
+        path: entry for path, entry in cache.items()
+        if isinstance(entry, dict) and
+        isinstance(entry.get("executable"), str) and
+        isinstance(entry.get("results"), dict) and
+        all(isinstance(result, list) and len(result) == 3
+            for result in entry["results"].values())
+    }
+
+
+def load_cache(executable_path, executable_hash, config) -> dict:
+    """
+    Loads cached test results for given executable
+    :param executable_path: The executable file path
+    :param executable_hash: Hash of the executable file contents
+    :param config: The configuration
+    :return: Cached results as dict (empty if nothing is cached)
+    """
+    if not config["tests_cache"] or config["_coverage"]:
+        return {}
+    entry = loaded_cache.get(executable_path)
+    if entry is None or entry["executable"] != executable_hash:
+        entry = read_cache(config).get(executable_path)
+    if entry is None or entry["executable"] != executable_hash:
+        entry = {"executable": executable_hash, "results": {}}
+    loaded_cache[executable_path] = entry
+    return entry["results"]
+
+
+def save_cache(executable_path, config) -> None:
+    """
+    Saves test results of given executable to the cache file, keeping
+    results of other executables
+    :param executable_path: The executable file path
+    :param config: The configuration
+    """
+    if not config["tests_cache"] or config["_coverage"]:
+        return
+    cache = read_cache(config)
+    cache[executable_path] = loaded_cache[executable_path]
+    with open(dirname / config["tests_cache"], "w") as cache_file:
+        cache_file.write(dumps(cache))
+
+
+def is_up_to_date(file_path, executable_path, flags_path, flags_hash) -> bool:
+    """
+    Checks whether the executable is newer than its source and was built
+    with the same compiler flags
+    :param file_path: A path to the c file
+    :param executable_path: A path to the executable built from it
+    :param flags_path: A path to the file with hash of the build flags
+    :param flags_hash: Hash of the current build flags
+    :return: True if the executable does not need to be rebuilt
+    """
+    executable_path = Path(executable_path)
+    if not executable_path.exists() or not flags_path.exists():
+        return False
+    if executable_path.stat().st_mtime <= file_path.stat().st_mtime:
+        return False
+    return flags_path.read_text() == flags_hash
+
+
 def build(file_path, config):
     """
     Builds given c file using given config
@@ -74,22 +189,55 @@ def build(file_path, config):
     """
     executable_path = str(file_path).replace(".c", ".exe")
     compiler_args = [config["compiler"]]
-    compiler_args += config["args"].split()
+    compiler_args += config["_args"]
     compiler_args += ["-o", executable_path]
-    compiler_args.append(str(file_path))
+    compiler_args.append(file_path)
+    # The flags hash is kept next to the executable to rebuild it when
+    # the compiler or its args change
+    flags_path = Path(executable_path + ".flags")
+    flags_hash = blake2b(" ".join(compiler_args[:-3]).encode()).hexdigest()
+    if is_up_to_date(file_path, executable_path, flags_path, flags_hash):
+        if config["_coverage"]:
+            # Recompiling used to reset coverage data, so it is removed here
+            # to count only the tests run with the reused executable
+            Path(executable_path).with_suffix(".gcda").unlink(missing_ok=True)
+        print(Colors.OKGREEN + Colors.BOLD + executable_path, "is up-to-date")
+        return executable_path
     print(Colors.ENDC + "Building", file_path, "using", config["compiler"],
           "...")
     process = run(compiler_args, capture_output=True)
     output = process.stdout
     error_output = process.stderr
     if not process.returncode:
+        flags_path.write_text(flags_hash)
         print(Colors.OKGREEN + Colors.BOLD + "Built", file_path, "to",
               executable_path)
         return executable_path
     else:
         print(Colors.FAIL + "Failed building", str(file_path) + Colors.ENDC)
-        print(output.decode(config["tests_encoding"]), file=stderr)
-        print(error_output.decode(config["tests_encoding"]), file=stderr)
+        # Invalid characters are replaced so that displaying can not fail
+        encoding = config["tests_encoding"]
+        print(output.decode(encoding, "replace"), file=stderr)
+        print(error_output.decode(encoding, "replace"), file=stderr)
+
+
+def parse_test_file_name(file_name):
+    """
+    Parses name of a test file like pos_01_in.txt or neg_02_out.txt
+    :param file_name: The file name
+    :return: Test type, index and file type (in/out) or None if given
+    file is not a test file
+    """
+    if len(file_name) == 13 and file_name[6:] == "_in.txt":
+        file_type = "in"
+    elif len(file_name) == 14 and file_name[6:] == "_out.txt":
+        file_type = "out"
+    else:
+        return None
+    if file_name[3] != "_" or file_name[:3] not in ("pos", "neg") or \
+            not file_name[4:6].isdecimal():
+        return None
+    return file_name[:3], file_name[4:6], file_type
 
 
 def test(executable_path, tests_path, config) -> None:
@@ -100,43 +248,56 @@ def test(executable_path, tests_path, config) -> None:
     :param config: The configuration
     """
     print(Colors.ENDC + "Testing", executable_path, "...")
-    test_file_regex = compile(config["test_file_regex"])
-    done_tests = []
+    tests = []
+    # scandir() gives plain names, so Path objects are only created for
+    # the matching test files
+    with scandir(tests_path) as entries:
+        for entry in entries:
+            file_name = entry.name
+            parsed = parse_test_file_name(file_name)
+            if parsed is None or parsed[2] != "in":
+                continue
+            test_type, index, _ = parsed
+            input_file = tests_path / file_name
+            output_file = tests_path / file_name.replace("_in.txt",
+                                                         "_out.txt")
+            tests.append((test_type, index, input_file, output_file))
+    with open(executable_path, "rb") as executable_file:
+        executable_hash = blake2b(executable_file.read()).hexdigest()
+    cache = load_cache(executable_path, executable_hash, config)
+    # Tests are independent and spend their time waiting for the child
+    # process, so threads are enough to run them concurrently. The number
+    # of threads limits the number of test processes running at once
+    jobs = config["tests_jobs"] or cpu_count()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(
+            lambda t: single_test(
+                executable_path, t[0], t[2], t[3], config, cache
+            ),
+            tests
+        ))
+    save_cache(executable_path, config)
+    # Indices are two-digit numbers, so tests are put in order by index
+    # instead of being sorted
     test_results = {
-        "pos": [],
-        "neg": []
+        "pos": [None] * 100,
+        "neg": [None] * 100
     }
-    for file in tests_path.iterdir():
-        file_name = file.name
-        if file_name in done_tests:
-            continue
-        matches = test_file_regex.search(file_name)
-        if matches is None:
-            continue
-        test_type, index, file_type = matches.groups()
-        if file_type == "in":
-            input_file = tests_path / file_name
-            output_file = tests_path / file_name.replace("in", "out")
-            result = single_test(
-                executable_path, test_type, input_file, output_file, config
-            )
-            test_results[test_type].append([index, result])
-            done_tests.append(input_file)
-            done_tests.append(output_file)
+    for (test_type, index, _, _), result in zip(tests, results):
+        test_results[test_type][int(index)] = [index, result]
     print()
     print(Colors.ENDC + "Positive tests:")
-    for t in list(sorted(test_results["pos"], key=lambda i: i[0])):
-        display_test(t)
+    display_tests("positive", test_results["pos"])
     print()
-    if test_results["neg"]:
+    if any(test_results["neg"]):
         print(Colors.ENDC + "Negative tests:")
-        for t in list(sorted(test_results["neg"], key=lambda i: i[0])):
-            display_test(t)
+        display_tests("negative", test_results["neg"])
         print()
     print(Colors.OKGREEN + Colors.BOLD + "Tested", executable_path)
 
 
-def single_test(executable_path, test_type, input_file, output_file, config):
+def single_test(executable_path, test_type, input_file, output_file, config,
+                cache):
     """
     Performs a single test on executable file
     :param executable_path: The path to executable file
@@ -144,23 +305,78 @@ def single_test(executable_path, test_type, input_file, output_file, config):
     :param input_file: Text file with input data
     :param output_file: Text file with expected output data
     :param config: Configuration
+    :param cache: Cached results of the executable, updated in place
     :return:
     """
     encoding = config["tests_encoding"]
-    process = run([executable_path],
-                  stdin=open(str(input_file), "r", encoding=encoding),
-                  capture_output=True)
-    output = process.stdout.decode(encoding)
-    error_output = process.stderr.decode(encoding)
-    expected_output = open(output_file, "r", encoding=encoding) \
-        .read().strip(" \n")
-    return_code = process.returncode
+    input_data = input_file.read_bytes()
+    key = blake2b(input_data).hexdigest()
+    if key in cache:
+        # Outputs are cached as latin-1 text which maps back to the
+        # original bytes one to one
+        return_code, output, error_output = cache[key]
+        output = output.encode("latin-1")
+        error_output = error_output.encode("latin-1")
+    else:
+        process = run([executable_path], input=input_data,
+                      capture_output=True)
+        output = process.stdout
+        error_output = process.stderr
+        return_code = process.returncode
+        cache[key] = [return_code, output.decode("latin-1"),
+                      error_output.decode("latin-1")]
+    # Outputs are only decoded to be displayed, so invalid characters are
+    # replaced instead of failing the whole run
+    error_output = error_output.decode(encoding, "replace") \
+        if error_output else ""
+    # Expected output is not read if the exit code already failed the test
     if test_type == "pos" and return_code != 0 or \
             test_type == "neg" and return_code == 0:
-        success = False
-    else:
-        success = output == expected_output
-    return success, return_code, output, expected_output, error_output
+        return False, return_code, output.decode(encoding, "replace"), \
+            None, error_output
+    # Outputs are compared as bytes and only decoded to be displayed
+    try:
+        expected_output = normalize_output(output_file.read_bytes())
+    except FileNotFoundError:
+        return False, return_code, output.decode(encoding, "replace"), \
+            "({} does not exist)".format(output_file.name), error_output
+    if normalize_output(output) == expected_output:
+        return True, return_code, None, None, error_output
+    return False, return_code, output.decode(encoding, "replace"), \
+        expected_output.decode(encoding, "replace"), error_output
+
+
+def normalize_output(output) -> bytes:
+    """
+    Converts CRLF and CR line endings to LF, as reading in text mode does,
+    and strips surrounding spaces and newlines
+    :param output: Output as bytes
+    :return: Normalized output as bytes
+    """
+    return output.replace(b"\r\n", b"\n").replace(b"\r", b"\n") \
+        .strip(b" \n")
+
+
+def display_tests(test_type, tests) -> None:
+    """
+    Displays failed tests of given type and a summary line for all of them
+    :param test_type: Test type name to display (positive/negative)
+    :param tests: An array of tests by index, each containing index and
+    result of the test or None if there is no test with such index
+    """
+    passed = 0
+    total = 0
+    for t in tests:
+        if t is None:
+            continue
+        total += 1
+        if t[1][0]:
+            passed += 1
+        else:
+            display_test(t)
+    print((Colors.OKGREEN if passed == total else Colors.FAIL) +
+          Colors.BOLD + "{}/{} {} tests passed".format(passed, total,
+                                                       test_type))
 
 
 def display_test(test_data) -> None:
@@ -176,8 +392,9 @@ def display_test(test_data) -> None:
         print(Colors.ENDC + "Exit code: {}".format(code))
         print(Colors.BOLD + "Output:")
         print(Colors.ENDC + output)
-        print(Colors.BOLD + "Expected output:")
-        print(Colors.ENDC + expected_output)
+        if expected_output is not None:
+            print(Colors.BOLD + "Expected output:")
+            print(Colors.ENDC + expected_output)
         print(Colors.BOLD + "Error output:")
         print(Colors.ENDC + error_output)
 
@@ -190,22 +407,18 @@ def coverage(file_path, config) -> None:
     """
     print(Colors.ENDC + "Running coverage for", file_path, "...")
     coverage_args = [config["coverage_meter"]]
-    coverage_args += config["coverage_meter_args"]
+    coverage_args += config["_coverage_meter_args"]
     coverage_args.append(str(file_path))
     run(coverage_args)
     print(Colors.OKGREEN + Colors.BOLD + "Ran coverage for", file_path)
 
 
-def main():
-    print()
-    print(Colors.HEADER + Colors.BOLD + "CTest tester script" + Colors.ENDC)
-    print()
-    file = get_file_name()
-    file_path = dirname / file
-    config = get_config()
-    if not file_path.exists():
-        print(Colors.FAIL + "Error: c source file does not exist!", file=stderr)
-        return
+def build_and_test(file_path, config) -> None:
+    """
+    Builds given c file, tests it and runs coverage meter
+    :param file_path: A path to the c file
+    :param config: The configuration
+    """
     tests_path = file_path.parent / config["tests_dir"]
     run_tests = True
     if not tests_path.exists():
@@ -218,10 +431,88 @@ def main():
         return
     print()
     test(executable_path, tests_path, config)
-    print()
-    coverage(file_path, config)
+    if config["coverage_meter"]:
+        print()
+        coverage(file_path, config)
     print(Colors.OKGREEN + Colors.BOLD + "Done!" + Colors.ENDC)
 
 
+def get_mtimes(file_path, config) -> dict:
+    """
+    Gets modification times of the c file and the files in tests directory
+    :param file_path: A path to the c file
+    :param config: The configuration
+    :return: Modification times by file path
+    """
+    mtimes = {}
+    # Files may be removed while they are listed, these are left out
+    try:
+        mtimes[str(file_path)] = file_path.stat().st_mtime
+    except FileNotFoundError:
+        pass
+    tests_path = file_path.parent / config["tests_dir"]
+    try:
+        with scandir(tests_path) as entries:
+            for entry in entries:
+                # Other files may be written by the runs themselves
+                if parse_test_file_name(entry.name) is None:
+                    continue
+                try:
+                    mtimes[entry.path] = entry.stat().st_mtime
+                except FileNotFoundError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return mtimes
+
+
+def watch(file_path, config) -> None:
+    """
+    Rebuilds and retests given c file every time it or its tests change
+    :param file_path: A path to the c file
+    :param config: The configuration
+    """
+    print()
+    print(Colors.ENDC + "Watching", file_path, "for changes...")
+    mtimes = get_mtimes(file_path, config)
+    try:
+        while True:
+            sleep(watch_interval)
+            new_mtimes = get_mtimes(file_path, config)
+            if new_mtimes == mtimes:
+                continue
+            mtimes = new_mtimes
+            print()
+            if not file_path.exists():
+                print(Colors.FAIL + "Error: c source file does not exist!",
+                      file=stderr)
+            else:
+                # Files may change while they are used, the next change
+                # runs everything again
+                try:
+                    build_and_test(file_path, config)
+                except OSError as error:
+                    print(Colors.FAIL + "Error:", error, file=stderr)
+            print()
+            print(Colors.ENDC + "Watching", file_path, "for changes...")
+    except KeyboardInterrupt:
+        print(Colors.ENDC)
+
+
+def main():
+    print()
+    print(Colors.HEADER + Colors.BOLD + "CTest tester script" + Colors.ENDC)
+    print()
+    args = get_args()
+    file_path = dirname / args.file
+    config = get_config()
+    if not file_path.exists():
+        print(Colors.FAIL + "Error: c source file does not exist!", file=stderr)
+        return
+    build_and_test(file_path, config)
+    if args.watch:
+        watch(file_path, config)
+
+
 if __name__ == "__main__":
     main()